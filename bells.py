@@ -38,16 +38,17 @@
                 "duration": 1,
                 "spacing": 1
             },
-            "test_thing": {}
+            "test_thing": {
+                "rings": 1,
+                "duration": 0.5,
+                "spacing": 0
+            }
         }
     }
 
     The above json will tell the system that Wednesdays are half days, and give the
     specific times for the different types of bells.
 
-    This module uses the schedule module (https://pypi.python.org/pypi/schedule) by
-    Daniel Bader.
-
     This module is licensed under MIT. See license.txt for more information.
 """
 #!/usr/bin/python
@@ -61,14 +62,23 @@
 # Disable pylint's dislike of lines > 100 characters.
 # pylint: disable=C0301
 
-# Python 3.x future-proofing.
-from __future__ import print_function
-
+import os
+import math
 import time
 import datetime
+import asyncio
+import queue
+import threading
+import signal
 import sys
-import json
 import logging
+from time import monotonic, sleep
+
+# Prefer the faster orjson parser when it's available.
+try:
+    import orjson as jsonParser
+except ImportError:
+    import json as jsonParser
 
 pinlessMode = False
 if not pinlessMode:
@@ -88,127 +98,340 @@ if not pinlessMode:
 
 # Establish logging.
 logging.basicConfig(filename="bellSchedule.log", filemode="w", format="%(asctime)s %(message)s", level=logging.DEBUG)
+logger = logging.getLogger(__name__)
 
-# Make sure we have the third party schedule module installed.
-try:
-    import schedule
-except ImportError:
-    logging.error("Could not find schedule module. Install the module using:")
-    logging.error("    pip install schedule")
-    sys.exit(0)
+# How often to check whether the system clock has been changed, in seconds.
+clockCheckInterval = 60
+
+# How far the system clock can move relative to the event loop's clock before the bells are
+# rescheduled, in seconds.
+maxClockDrift = 1
+
+# The time of day to reload the schedule from our json dataset, in minutes past midnight.
+reloadTime = 2 * 60
+
+# The settings every pattern must define, the types they can be, and their largest allowed value.
+patternSettings = {
+    "rings": ((int,), 20),
+    "duration": ((int, float), 300),
+    "spacing": ((int, float), 300)
+}
+
+# Day names used by the default calendar, in date.weekday() order.
+dayNames = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
+# Set when a reload has been requested with SIGHUP. Repeated requests are coalesced into a
+# single reload.
+reloadRequested = False
 
 jsonFile = None
+jsonFileMtime = None
+jsonFileSize = None
 jsonConfig = None
-curSchedule = None
-
-def power_bells(state):
-    """Powers or unpowers the bells."""
-    if not pinlessMode:
-        if state:
-            for pin in bellPins:
-                GPIO.output(pin, GPIO.HIGH)
-        elif not state:
-            for pin in bellPins:
-                GPIO.output(pin, GPIO.LOW)
-    else:
-        logging.debug("Bell state: " + str(state))
-
-def ring_bells():
-    """Rings the school bells in a pattern for the given schedule/time."""
-    # Need to get the pattern for this time slot and apply it.
-    curTime = time.strftime("%H:%M")
-    if curTime not in jsonConfig["schedules"][curSchedule]:
-        logging.error("Couldn't find time record for time " + curTime + " in schedule " + curSchedule)
-        return
+weeklySchedules = (None,) * 7
 
-    # Obtain the pattern to use.
-    pattern = jsonConfig["schedules"][curSchedule][curTime]
-    if pattern not in jsonConfig["patterns"]:
-        logging.error("Could not find pattern '" + pattern + "'.")
-        return
+# Patterns waiting to be played by the bell worker thread, as (pattern, rings, duration, spacing).
+bellQueue = queue.Queue()
+
+# Event loop handles for the upcoming bells and the next daily reload.
+bellHandles = []
+reloadHandle = None
+
+# The difference between the system clock and the event loop's clock when the bells were
+# last scheduled.
+clockOffset = 0
+
+# Pick how to power the bells once, rather than checking on every ring.
+if not pinlessMode:
+    gpioOutput = GPIO.output
+    gpioHigh = GPIO.HIGH
+    gpioLow = GPIO.LOW
+    bellPinTuple = tuple(bellPins)
+
+    def power_bells(state):
+        """Powers or unpowers the bells."""
+        # Drive every bell pin in a single call, so the bells switch together.
+        gpioOutput(bellPinTuple, gpioHigh if state else gpioLow)
+else:
+    def power_bells(state):
+        """Logs the bell state in place of powering the bells."""
+        logger.debug("Bell state: %s", state)
 
-    # Play the pattern.
-    logging.debug("Playing bell: " + pattern)
-    bellRings = jsonConfig["patterns"][pattern]["rings"]
-    bellDuration = jsonConfig["patterns"][pattern]["duration"]
-    bellSpacing = jsonConfig["patterns"][pattern]["spacing"]
-    for _ in range(bellRings):
+def play_pattern(rings, duration, spacing):
+    """Rings the school bells in the given pattern."""
+    # Sleep until fixed deadlines measured from the start of the pattern, so any
+    # oversleeping doesn't accumulate over multiple rings.
+    startTime = monotonic()
+    for ring in range(rings):
+        ringStart = startTime + ring * (duration + spacing)
+        sleep(max(0, ringStart - monotonic()))
         power_bells(True)
-        time.sleep(bellDuration)
+        sleep(max(0, ringStart + duration - monotonic()))
         power_bells(False)
-        time.sleep(bellSpacing)
+
+def make_bell_ringer(pattern, params):
+    """Creates a job that rings the bells using an already resolved pattern."""
+    rings = params["rings"]
+    duration = params["duration"]
+    spacing = params["spacing"]
+
+    def ring_bells():
+        """Queues the bound pattern to be played by the bell worker."""
+        bellQueue.put((pattern, rings, duration, spacing))
+
+    return ring_bells
+
+def bell_worker():
+    """Plays queued bell patterns one at a time, so playing them never blocks the event loop."""
+    while True:
+        pattern, rings, duration, spacing = bellQueue.get()
+        logger.debug("Playing bell: %s", pattern)
+
+        # A failed pattern must not stop the worker, or leave the bells powered.
+        try:
+            play_pattern(rings, duration, spacing)
+        except Exception: # pylint: disable=broad-except
+            logger.exception("Could not play bell: %s", pattern)
+        finally:
+            try:
+                power_bells(False)
+            except Exception: # pylint: disable=broad-except
+                logger.exception("Could not unpower the bells.")
+
+def seconds_until(clockTime, now):
+    """Returns the seconds from the timestamp now until the clock next reads the given minutes past midnight."""
+    localNow = time.localtime(now)
+    secondsIntoDay = localNow.tm_hour * 3600 + localNow.tm_min * 60 + localNow.tm_sec + now % 1
+    delay = (clockTime * 60 - secondsIntoDay) % 86400
+    return delay if delay > 0 else 86400
+
+def parse_bell_time(bellTime):
+    """Converts a zero-padded "HH:MM" bell time to minutes past midnight. Returns None if it's malformed."""
+    if len(bellTime) != 5 or bellTime[2] != ":" or not (bellTime[:2] + bellTime[3:]).isdecimal():
+        return None
+    hour = int(bellTime[:2])
+    minute = int(bellTime[3:])
+    if hour > 23 or minute > 59:
+        return None
+    return hour * 60 + minute
+
+def validate_config(config):
+    """Checks the structure of a json config. Returns a list of any problems found."""
+    if not isinstance(config, dict):
+        return ["The config must be a json object."]
+
+    errors = []
+    calendar = config.get("calendar")
+    if not isinstance(calendar, dict) or not isinstance(calendar.get("default"), dict):
+        errors.append("Invalid calendar table.")
+    else:
+        for day, scheduleName in calendar.items():
+            if day != "default" and not isinstance(scheduleName, str):
+                errors.append("Invalid schedule for calendar date '%s'." % day)
+        for day, scheduleName in calendar["default"].items():
+            if not isinstance(scheduleName, str):
+                errors.append("Invalid schedule for default calendar day '%s'." % day)
+
+    schedules = config.get("schedules")
+    if not isinstance(schedules, dict):
+        errors.append("Invalid schedules table.")
+    else:
+        for scheduleName, bells in schedules.items():
+            if not isinstance(bells, dict):
+                errors.append("Invalid schedule '%s'." % scheduleName)
+                continue
+            for bellTime, pattern in bells.items():
+                if not isinstance(pattern, str):
+                    errors.append("Invalid pattern for bell at %s in schedule '%s'." % (bellTime, scheduleName))
+
+    patterns = config.get("patterns")
+    if not isinstance(patterns, dict):
+        errors.append("Invalid patterns table.")
+        return errors
+
+    for pattern, params in patterns.items():
+        if not isinstance(params, dict):
+            errors.append("Invalid pattern '%s'." % pattern)
+            continue
+        for setting, (types, maximum) in patternSettings.items():
+            value = params.get(setting)
+            if isinstance(value, bool) or not isinstance(value, types):
+                errors.append("Invalid %s for pattern '%s'." % (setting, pattern))
+            elif not 0 <= value <= maximum or not math.isfinite(value):
+                errors.append("Invalid %s for pattern '%s'. It must be between 0 and %s." % (setting, pattern, maximum))
+
+    return errors
+
+def keep_cached_config():
+    """Falls back to the last valid config after a failed load. Returns False if there isn't one."""
+    if jsonConfig is None:
+        return False
+    logger.error("Continuing with the last valid json config.")
+    return True
+
+def load_config():
+    """Loads the json config from disk. Returns False if there is no valid config to use."""
+    global jsonConfig
+    global jsonFileMtime
+    global jsonFileSize
+    global weeklySchedules
+
+    # Editors often replace a file when saving, so it may briefly be missing or incomplete. If
+    # we can't load a new config, we keep using the last valid one.
+    try:
+        fileStat = os.stat(jsonFile)
+    except OSError as error:
+        logger.error("Could not read json config: %s", error)
+        return keep_cached_config()
+
+    # Don't bother reparsing the file if it hasn't changed since we last loaded it.
+    if jsonConfig is not None and (fileStat.st_mtime_ns, fileStat.st_size) == (jsonFileMtime, jsonFileSize):
+        logger.debug("Json config unchanged. Using cached config.")
+        return True
+
+    logger.debug("Loading json config...")
+    try:
+        with open(jsonFile, "rb") as jsonFileHandle:
+            newConfig = jsonParser.loads(jsonFileHandle.read())
+    except (OSError, ValueError) as error:
+        logger.error("Could not read json config: %s", error)
+        return keep_cached_config()
+
+    # Check that default structure for json config is respected.
+    errors = validate_config(newConfig)
+    if errors:
+        for error in errors:
+            logger.error("Malformed json config. %s", error)
+        return keep_cached_config()
+
+    # Only cache a config that passed validation.
+    jsonConfig = newConfig
+    weeklySchedules = tuple(jsonConfig["calendar"]["default"].get(dayName) for dayName in dayNames)
+    jsonFileMtime = fileStat.st_mtime_ns
+    jsonFileSize = fileStat.st_size
+    return True
+
+def request_reload():
+    """Signal handler that asks the event loop to reload the schedule."""
+    global reloadRequested
+    if not reloadRequested:
+        reloadRequested = True
+        asyncio.get_running_loop().call_soon(run_requested_reload)
+
+def run_requested_reload():
+    """Reloads the schedule after a reload was requested."""
+    global reloadRequested
+    reloadRequested = False
+    logger.debug("Reload requested.")
+    reload_schedule()
+
+def check_clock():
+    """Reschedules the bells if the system clock has been changed since they were scheduled."""
+    # Schedule the next check first, so a failed reload can't stop us watching the clock.
+    loop = asyncio.get_running_loop()
+    loop.call_later(clockCheckInterval, check_clock)
+    if abs(time.time() - loop.time() - clockOffset) > maxClockDrift:
+        logger.debug("System clock changed. Rescheduling bells.")
+        reload_schedule()
 
 def reload_schedule():
     """Reloads the schedule from our json file."""
-    global jsonConfig
-    global curSchedule
+    global bellHandles
+    global reloadHandle
+    global clockOffset
 
-    jsonConfig = None
-    curSchedule = None
+    loop = asyncio.get_running_loop()
 
     # Clear currently scheduled bells.
-    schedule.clear("current")
+    for handle in bellHandles:
+        handle.cancel()
+    bellHandles = []
 
-    logging.debug("Reloading schedule...")
-    with open(jsonFile) as jsonFileHandle:
-        jsonConfig = json.load(jsonFileHandle)
+    # Bell times are on the system clock, but the event loop keeps its own clock. Read both
+    # at once, so we can schedule against one and notice if the other is changed.
+    loopNow = loop.time()
+    now = time.time()
+    clockOffset = now - loopNow
 
-    # Check that default structure for json config is respected.
-    if "calendar" not in jsonConfig or "default" not in jsonConfig["calendar"]:
-        logging.error("Malformed json config. Invalid calendar table.")
-        return
-    elif "schedules" not in jsonConfig:
-        logging.error("Malformed json config. Invalid schedules table.")
-        return
-    elif "patterns" not in jsonConfig:
-        logging.error("Malformed json config. Invalid patterns table.")
+    # Once a day, we want to reload the schedule from our json dataset.
+    if reloadHandle is not None:
+        reloadHandle.cancel()
+    reloadHandle = loop.call_at(loopNow + seconds_until(reloadTime, now), reload_schedule)
+
+    logger.debug("Reloading schedule...")
+    if not load_config():
         return
 
     # Check to see if this date has a specific schedule.
-    curDate = datetime.datetime.today().strftime("%Y-%m-%d")
+    today = datetime.date.today()
+    curDate = today.isoformat()
     if curDate in jsonConfig["calendar"]:
         curSchedule = jsonConfig["calendar"][curDate]
     else:
         # If this isn't a special day, we look up the schedule by day of the week.
-        curDayOfWeek = datetime.datetime.now().strftime("%A")
-        if curDayOfWeek in jsonConfig["calendar"]["default"]:
-            curSchedule = jsonConfig["calendar"]["default"][curDayOfWeek]
-        else:
-            logging.debug("No schedule found for date.")
+        curSchedule = weeklySchedules[today.weekday()]
+        if curSchedule is None:
+            logger.debug("No schedule found for date.")
             return
 
     # Now that we have the schedule to use, does it exist?
     if curSchedule not in jsonConfig["schedules"]:
-        logging.error("Schedule" + curSchedule + " not found in json config. Aborting.")
+        logger.error("Schedule %s not found in json config. Aborting.", curSchedule)
         return
 
-    # Add bells for this schedule.
-    for bellTime in jsonConfig["schedules"][curSchedule]:
-        schedule.every().day.at(bellTime).do(ring_bells).tag("current")
-        logging.debug("Scheduled bells using pattern '" + jsonConfig["schedules"][curSchedule][bellTime] + "' at " + bellTime)
+    # Resolve the pattern for each bell now, so ringing a bell doesn't need to look anything up.
+    # Bells are keyed by their time in minutes past midnight.
+    activeSchedule = {}
+    for bellTime, pattern in jsonConfig["schedules"][curSchedule].items():
+        bellMinute = parse_bell_time(bellTime)
+        if bellMinute is None:
+            logger.error("Invalid bell time '%s' in schedule %s. Times must be in the HH:MM format.", bellTime, curSchedule)
+            continue
+        elif pattern not in jsonConfig["patterns"]:
+            logger.error("Could not find pattern '%s' for bell at %s.", pattern, bellTime)
+            continue
+        activeSchedule[bellMinute] = (pattern, jsonConfig["patterns"][pattern])
 
-# Make sure our first argument is a file.
-if len(sys.argv) != 2:
-    logging.error("Invalid use. Usage:")
-    logging.error("    sudo python " + sys.argv[0] + " <path to json config>")
-    sys.exit(0)
-jsonFile = sys.argv[1]
+    # Add bells for this schedule. Bells that have already passed today are scheduled for
+    # tomorrow, until the next reload.
+    newHandles = []
+    for bellMinute, (pattern, params) in activeSchedule.items():
+        newHandles.append(loop.call_at(loopNow + seconds_until(bellMinute, now), make_bell_ringer(pattern, params)))
+        logger.debug("Scheduled bells using pattern '%s' at %02d:%02d", pattern, *divmod(bellMinute, 60))
+    bellHandles = newHandles
 
-# Main execution
-try:
-    logging.debug("System online.")
+async def main():
+    """Schedules the bells, then lets the event loop sleep until each one is due."""
+    loop = asyncio.get_running_loop()
+
+    # Allow the schedule to be reloaded on demand with SIGHUP, where it's supported.
+    if hasattr(signal, "SIGHUP"):
+        loop.add_signal_handler(signal.SIGHUP, request_reload)
+
+    # Bell patterns are played on their own thread.
+    threading.Thread(target=bell_worker, name="bell_worker", daemon=True).start()
 
     # Initial calls.
     reload_schedule()
+    loop.call_later(clockCheckInterval, check_clock)
 
-    # At 2am, we want to reload the schedule from our json dataset.
-    schedule.every().day.at("02:00").do(reload_schedule)
+    # Everything else happens in callbacks scheduled on the event loop.
+    await loop.create_future()
 
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
-except KeyboardInterrupt:
-    logging.debug("Execution manually broken.")
-finally:
-    if not pinlessMode:
-        GPIO.cleanup()
+if __name__ == "__main__":
+    # Make sure our first argument is a file.
+    if len(sys.argv) != 2:
+        logger.error("Invalid use. Usage:")
+        logger.error("    sudo python3 %s <path to json config>", sys.argv[0])
+        sys.exit(0)
+    jsonFile = sys.argv[1]
+
+    # Main execution
+    try:
+        logger.debug("System online.")
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.debug("Execution manually broken.")
+    finally:
+        if not pinlessMode:
+            GPIO.cleanup()